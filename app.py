@@ -10,6 +10,21 @@ Usage:
   app will be accessible to only your computer at "localhost" on any web 
   browser.
     
+* To reduce memory usage, add the --compact flag to store monthly series as
+  float32 and building attributes as categoricals:
+    > python app.py --compact path_to_data.csv
+  Add --memory-report to print the memory footprint of each column group.
+
+* To filter and color buildings by anomaly score, add the scores to the data
+  file once with scan_anomalies.py, or add --scan-anomalies to scan the data
+  at startup instead.
+
+* To diagnose slow callbacks, add --profile-ms 500 to save a sampled stack
+  trace of every callback slower than 500 ms, or --profile-every 100 to save
+  a cProfile trace of one of every 100 callbacks. The newest traces are
+  listed at /_profiles and can be downloaded at /_profiles/<name> (add
+  ?format=txt for a summary).
+
 * To run in public mode, type the following in the terminal:
     > python app.py --public path_to_data.csv
   where path_to_data.csv is the path to the csv file containing the data. The
@@ -23,6 +38,7 @@ Required libraries:
 * dash-core-components (have to install separately, see https://plot.ly/dash/installation)
 * dash-html-components (have to install separately, see https://plot.ly/dash/installation)
 * dash-auth (have to install separately, see https://plot.ly/dash/installation)
+* flask (installed with dash)
 
 Anthony Ho <anthony.ho@energy.ca.gov>
 Last updated 8/30/2017
@@ -39,6 +55,8 @@ from dash.dependencies import Input, Output
 import argparse
 from collections import OrderedDict
 import lib
+import http_cache
+import profiler
 
 
 # Define links to logo and css templates for the web app
@@ -67,22 +85,60 @@ dict_unit = OrderedDict([('raw', 'Raw'),
                          ('EUI', 'EUI')])
 dict_stat = OrderedDict([('avg', 'Average annual total'),
                          ('fit', 'Trend')])
+dict_anom = OrderedDict([('all', 'All'),
+                         ('flagged', 'Anomalous only')])
 list_colorby = ['Building type', 'Climate zone',
                 'IOU', 'Fuel type',
-                'Consumption', 'Year built', 'Building area']
+                'Consumption', 'Year built', 'Building area', 'Anomaly']
 
 # Get path to data file and public/private option from command line
 description = 'Interactive web app for visualizing building energy data'
 parser = argparse.ArgumentParser(description=description)
 parser.add_argument('--public', action='store_true',
                     help='run app in public mode')
+parser.add_argument('--compact', action='store_true',
+                    help='store monthly series in reduced precision to save memory')
+parser.add_argument('--memory-report', action='store_true',
+                    help='print memory footprint of the data per column group')
+parser.add_argument('--scan-anomalies', action='store_true',
+                    help='scan monthly traces for anomalies at startup')
+parser.add_argument('--cache-mb', type=float, default=64,
+                    help='size of the callback response cache in MB (0 to disable)')
+parser.add_argument('--profile-ms', type=float, default=None,
+                    help='save profiles of callbacks slower than this (in ms)')
+parser.add_argument('--profile-every', type=int, default=None,
+                    help='save profiles of every n-th callback')
+parser.add_argument('--profile-dir', default='profiles',
+                    help='directory to save profiles to')
 parser.add_argument('file', help='path to the billing data file')
 args = parser.parse_args()
 bills_file = args.file
 public_mode = args.public
+compact_mode = args.compact
+memory_report = args.memory_report
+scan_mode = args.scan_anomalies
+cache_mb = args.cache_mb
+profile_ms = args.profile_ms
+profile_every = args.profile_every
+profile_dir = args.profile_dir
 
 # Read data file
-bills = lib.read_processed_bills(bills_file)
+bills = lib.read_processed_bills(bills_file, compact=compact_mode)
+if memory_report:
+    print(lib.memory_footprint(bills).to_string(float_format='{:.1f}'.format))
+# Scan monthly traces for step changes, spikes and zero runs unless the
+# scores were already added to the data file by scan_anomalies.py
+if scan_mode:
+    scores = lib.scan_anomalies(bills)
+    for col in scores:
+        bills[col] = scores[col]
+anom_mode = all(('summary', 'EUI_' + fuel + '_anom_score') in bills
+                for fuel in dict_fuel2)
+if not anom_mode:
+    list_colorby.remove('Anomaly')
+    del dict_anom['flagged']
+# Precompute median and interquartile traces of each building type and cz
+peers = lib.get_peer_traces(bills)
 
 # Extract username and password from auth.csv
 auth_list = pd.read_csv('auth.csv').values.tolist()
@@ -104,6 +160,16 @@ dict_area = {area: str(area) for area in range(min_area, max_area + 1)
 app = dash.Dash('auth')
 auth = dash_auth.BasicAuth(app, auth_list)
 
+# Compress callback responses and cache them by callback inputs and dataset
+if cache_mb > 0:
+    http_cache.enable_response_cache(app, http_cache.dataset_version(bills_file),
+                                     max_mb=cache_mb, auth=auth)
+
+# Profile slow or sampled callbacks, listed at /_profiles
+if profile_ms is not None or profile_every is not None:
+    profiler.enable_profiling(app, profile_dir, threshold_ms=profile_ms,
+                              sample_every=profile_every, auth=auth)
+
 
 # Define app panel components
 
@@ -137,6 +203,10 @@ filter_fuel = dcc.RadioItems(id='filter_fuel',
                              options=lib.to_options(dict_fuel1),
                              value='both',
                              labelStyle={'display': 'inline-block'})
+filter_anom = dcc.RadioItems(id='filter_anom',
+                             options=lib.to_options(dict_anom),
+                             value='all',
+                             labelStyle={'display': 'inline-block'})
 filter_value = dcc.RangeSlider(id='filter_value',
                                min=0, max=1000, step=0.1,
                                marks={i: str(i)
@@ -184,6 +254,9 @@ html_lowerleft = html.Div([html.Div([html.Label('Select climate zone:'),
                                               style={'margin-bottom': '10'}),
                                      html.Label('Select fuel type:'),
                                      html.Div([filter_fuel],
+                                              style={'margin-bottom': '10'}),
+                                     html.Label('Select anomaly:'),
+                                     html.Div([filter_anom],
                                               style={'margin-bottom': '0'})],
                                     className='three columns'),
                            html.Div([html.Label('Consumption range:'),
@@ -288,9 +361,11 @@ for css in css_links:
                Input('metric_unit', 'value'),
                Input('metric_fuel', 'value'),
                Input('metric_stat', 'value'),
-               Input('colorby', 'value')])
+               Input('colorby', 'value'),
+               Input('filter_anom', 'value')])
 def update_map(types_tf, cz_tf, iou_tf, year_tf, area_tf,
-               fuel_tf, value_tf, unit_tu, fuel_tu, stat_tu, colorby_value):
+               fuel_tf, value_tf, unit_tu, fuel_tu, stat_tu, colorby_value,
+               anom_tf):
     if stat_tu == 'fit':
         value_suffix = '_slope'
     else:
@@ -300,7 +375,9 @@ def update_map(types_tf, cz_tf, iou_tf, year_tf, area_tf,
                                types_tf=types_tf, cz_tf=cz_tf,
                                iou_tf=iou_tf,
                                year_tf=year_tf, year_lim=(min_year, max_year),
-                               area_tf=area_tf, area_lim=(min_area, max_area))
+                               area_tf=area_tf, area_lim=(min_area, max_area),
+                               anom_field='EUI_' + fuel_tu + '_anom_score',
+                               anom_min=1 if anom_tf == 'flagged' else None)
     return lib.plot_map(bills_pf, colorby_value, value)
 
 
@@ -309,38 +386,28 @@ def update_map(types_tf, cz_tf, iou_tf, year_tf, area_tf,
 def update_building_info(clickData):
     # Get current building
     bldg = bills.iloc[lib.get_iloc(clickData)]
-    # Define field of variables
-    EUI_field = ('summary', 'EUI_tot_avg_2009_2015')
-    trend_field = ('summary', 'EUI_tot_fit_2009_2015_slope')
-    year_field = ('cis', 'year_built')
-    area_field = ('cis', 'building_area')
-    address = (bldg['cis']['address'].title() + ', ' +
-               bldg['cis']['city'].title() + ', CA ' + bldg['cis']['zip'])
-    link_map = 'https://www.google.com/maps/place/' + address.replace(' ', '+')
+    info = lib.get_bldg_info(bldg)
     # Define text
     p = []
-    p.append('**Address:**  [' + address + '](' + link_map + ')')
-    p.append('**Utility:**  ' + lib.name_iou(bldg['cis']['iou']))
-    p.append('**Building type:**  ' + bldg['cis']['building_type'])
-    p.append('**Climate zone:**  ' + bldg['cis']['cz'])
-    p.append('**6-year average annual EUI:**  {:.1f} kBTU/ft²'.format(bldg[EUI_field]))
-    p.append('**Change in annual EUI over 6 years:**  {:.1f} kBTU/ft²/year'.format(bldg[trend_field]))
-    p.append('**Year built:**  {}'.format(int(bldg[year_field])))
-    p.append('**Floor area:**  {:,.0f} ft²'.format(bldg[area_field]))
+    for label, text in info.items():
+        if label == 'Address':
+            text = '[' + text + '](' + lib.link_map(text) + ')'
+        p.append('**' + label + ':**  ' + text)
     return [dcc.Markdown(item) for item in p]
 
 
 @app.callback(Output('fulltrace', 'figure'),
               [Input('map', 'clickData')])
 def update_fulltrace(clickData):
-    return lib.plot_bldg_full_timetrace(bills, lib.get_iloc(clickData))
+    return lib.plot_bldg_full_timetrace(bills, lib.get_iloc(clickData),
+                                        peers=peers)
 
 
 @app.callback(Output('avg_monthly', 'figure'),
               [Input('map', 'clickData')])
 def update_avg_monthly(clickData):
     return lib.plot_bldg_avg_monthly(bills, lib.get_iloc(clickData),
-                                     year_range=(2009, 2015))
+                                     year_range=(2009, 2015), peers=peers)
 
 
 @app.callback(Output('hist_avg', 'figure'),
@@ -367,14 +434,17 @@ def update_hist_trend(clickData):
                Input('filter_value', 'value'),
                Input('metric_unit', 'value'),
                Input('metric_fuel', 'value'),
-               Input('metric_stat', 'value')])
+               Input('metric_stat', 'value'),
+               Input('filter_anom', 'value')])
 def update_boxplot(types_tf, cz_tf, iou_tf, year_tf, area_tf,
-                   fuel_tf, value_tf, unit_tu, fuel_tu, stat_tu):
+                   fuel_tf, value_tf, unit_tu, fuel_tu, stat_tu, anom_tf):
     bills_pf = lib.filter_bldg(bills,
                                types_tf=list_types, cz_tf=cz_tf,
                                iou_tf=iou_tf,
                                year_tf=year_tf, year_lim=(min_year, max_year),
-                               area_tf=area_tf, area_lim=(min_area, max_area))
+                               area_tf=area_tf, area_lim=(min_area, max_area),
+                               anom_field='EUI_' + fuel_tu + '_anom_score',
+                               anom_min=1 if anom_tf == 'flagged' else None)
     if stat_tu == 'fit':
         value_suffix = '_slope'
     else:
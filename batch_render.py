@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+'''
+Headless batch renderer of per-building reports
+
+Usage:
+
+* To render reports of all buildings of a given type and climate zone, type
+  the following in the terminal:
+    > python batch_render.py path_to_data.csv out_dir --types 'Office building' --cz 3 4
+  where path_to_data.csv is the path to the csv file containing the data and
+  out_dir is the directory to write the reports to. Each report contains the
+  building info, the full time trace, the average monthly trace and the
+  histograms of average annual EUI and trend of a building.
+
+* To render reports of a given list of buildings, type the following in the
+  terminal:
+    > python batch_render.py path_to_data.csv out_dir --buildings list.txt
+  where list.txt contains one building index (as used by the app) per line.
+
+* Add --format html to write static html pages instead of json figures, and
+  --processes N to set the number of worker processes. Buildings whose report
+  already exists in out_dir are skipped, so an interrupted run can be resumed
+  by rerunning the same command.
+
+Anthony Ho <anthony.ho@energy.ca.gov>
+'''
+
+
+import os
+import sys
+import time
+import json
+import argparse
+import multiprocessing
+from html import escape
+import plotly
+import lib
+
+
+# Define figures included in each report
+hist_values = [('hist_avg', ('summary', 'EUI_tot_avg_2009_2015')),
+               ('hist_trend', ('summary', 'EUI_tot_fit_2009_2015_slope'))]
+plotlyjs_link = 'https://cdn.plot.ly/plotly-latest.min.js'
+
+# Dataset shared between worker processes. Loaded once in the parent so that
+# workers started with the fork method share it copy-on-write; reloaded in the
+# initializer by workers started otherwise (spawn on Windows, where fork is
+# unavailable)
+bills = None
+peers = None
+
+
+def _init_worker(file, compact):
+    global bills, peers
+    if bills is None:
+        bills = lib.read_processed_bills(file, compact=compact)
+        peers = lib.get_peer_traces(bills)
+
+
+def render_bldg(i):
+    """Render the report figures of building i as a dict"""
+    bldg = bills.iloc[i]
+    figures = {'fulltrace': lib.plot_bldg_full_timetrace(bills, i,
+                                                         peers=peers),
+               'avg_monthly': lib.plot_bldg_avg_monthly(bills, i,
+                                                        year_range=(2009, 2015),
+                                                        peers=peers)}
+    for name, value in hist_values:
+        figures[name] = lib.plot_bldg_hist(bills, i, value)
+    return {'index': int(bills.index[i]),
+            'info': lib.get_bldg_info(bldg),
+            'figures': figures}
+
+
+def to_html(report):
+    """Convert a rendered report to a static html page"""
+    info = report['info']
+    rows = ''.join('<tr><th>{}</th><td>{}</td></tr>'.format(escape(label),
+                                                            escape(text))
+                   for label, text in info.items())
+    divs = ''.join(plotly.offline.plot(fig, output_type='div',
+                                       include_plotlyjs=False)
+                   for fig in report['figures'].values())
+    return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+            '<title>{title}</title><script src="{js}"></script></head>'
+            '<body><h1>{title}</h1><table>{rows}</table>{divs}</body></html>\n'
+            ).format(title=escape(info['Address']), js=plotlyjs_link,
+                     rows=rows, divs=divs)
+
+
+def report_path(out_dir, i, fmt):
+    return os.path.join(out_dir, 'bldg_{}.{}'.format(i, fmt))
+
+
+def _render_to_file(job):
+    i, out_dir, fmt = job
+    report = render_bldg(i)
+    if fmt == 'html':
+        content = to_html(report)
+    else:
+        content = json.dumps(report, cls=plotly.utils.PlotlyJSONEncoder)
+    # Write to a temporary file first so that an interrupted run never leaves
+    # a partial report behind to be mistaken as done when resuming
+    path = report_path(out_dir, i, fmt)
+    with open(path + '.tmp', 'w') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+    return i
+
+
+def select_bldgs(df, args):
+    """Get positions of buildings to be rendered from command line args"""
+    if args.buildings is not None:
+        with open(args.buildings) as f:
+            return [int(line) for line in f if line.strip()]
+    if args.types is None and args.cz is None and args.iou is None:
+        return list(range(len(df)))
+    year_lim = (df['cis']['year_built'].min(), df['cis']['year_built'].max())
+    area_lim = (df['cis']['building_area'].min(),
+                df['cis']['building_area'].max())
+    df_pf = lib.filter_bldg(df,
+                            types_tf=args.types or list(df['cis']['building_type'].unique()),
+                            cz_tf=args.cz or list(df['cis']['cz'].unique()),
+                            iou_tf=args.iou or ['pge', 'sce', 'scg', 'sdge'],
+                            year_tf=year_lim, year_lim=year_lim,
+                            area_tf=area_lim, area_lim=area_lim)
+    return list(df.index.get_indexer(df_pf.index))
+
+
+def main():
+    global bills, peers
+    description = 'Render per-building reports of the web app in batch'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--buildings',
+                        help='file containing one building index per line')
+    parser.add_argument('--types', nargs='+',
+                        help='building types to render')
+    parser.add_argument('--cz', nargs='+',
+                        help='climate zones to render')
+    parser.add_argument('--iou', nargs='+',
+                        help='IOUs to render')
+    parser.add_argument('--format', choices=['json', 'html'], default='json',
+                        help='output format of the reports')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--compact', action='store_true',
+                        help='store monthly series in reduced precision to save memory')
+    parser.add_argument('file', help='path to the billing data file')
+    parser.add_argument('out_dir', help='directory to write the reports to')
+    args = parser.parse_args()
+
+    # Read data file and select buildings
+    bills = lib.read_processed_bills(args.file, compact=args.compact)
+    peers = lib.get_peer_traces(bills)
+    list_bldgs = select_bldgs(bills, args)
+
+    # Skip buildings rendered by previous runs
+    os.makedirs(args.out_dir, exist_ok=True)
+    todo = [i for i in list_bldgs
+            if not os.path.exists(report_path(args.out_dir, i, args.format))]
+    n_done = len(list_bldgs) - len(todo)
+    print('{} buildings selected, {} already rendered'.format(len(list_bldgs),
+                                                              n_done))
+
+    # Render across a process pool
+    jobs = [(i, args.out_dir, args.format) for i in todo]
+    start = time.time()
+    # Request fork explicitly where available since the default start method
+    # is not fork on all platforms and Python versions
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    with context.Pool(args.processes, initializer=_init_worker,
+                      initargs=(args.file, args.compact)) as pool:
+        for n, _ in enumerate(pool.imap_unordered(_render_to_file, jobs,
+                                                  chunksize=8), 1):
+            if n % 100 == 0 or n == len(jobs):
+                elapsed = time.time() - start
+                rate = n / elapsed
+                eta = (len(jobs) - n) / rate
+                sys.stdout.write('\r{}/{} rendered, {:.1f} buildings/s, '
+                                 'ETA {:.0f} s'.format(n + n_done,
+                                                       len(list_bldgs),
+                                                       rate, eta))
+                sys.stdout.flush()
+    print('\nDone in {:.1f} s'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Anthony Ho <anthony.ho@energy.ca.gov>
+"""
+Compression and ETag caching of Dash callback responses
+"""
+
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+import flask
+
+
+update_path = '_dash-update-component'
+
+
+def dataset_version(file):
+    """Function to define the version of a data file from its path, size and
+    modification time"""
+    stat = os.stat(file)
+    key = '{}:{}:{}'.format(os.path.abspath(file), stat.st_size, stat.st_mtime)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def enable_response_cache(app, version, max_mb=64, min_size=1024,
+                          compresslevel=6, auth=None):
+    """Function to gzip callback responses of a Dash app and cache them in a
+    bounded LRU cache keyed by a content hash of the callback inputs and the
+    dataset version. The hash is sent as ETag, so repeated requests are
+    answered with 304 or with the cached body without rerunning the callback.
+    Only valid for callbacks that are pure functions of their inputs and the
+    dataset. If auth (e.g. dash_auth.BasicAuth) is given, only authorized
+    requests are served from the cache"""
+    server = app.server
+    max_bytes = max_mb * 2**20
+    cache = OrderedDict()
+    size = [0]
+    lock = threading.Lock()
+
+    def _is_update():
+        return (flask.request.method == 'POST' and
+                flask.request.path.endswith(update_path))
+
+    def _accepts_gzip():
+        return flask.request.accept_encodings['gzip'] > 0
+
+    def _lookup(etag):
+        with lock:
+            body_gz = cache.get(etag)
+            if body_gz is not None:
+                cache.move_to_end(etag)
+        return body_gz
+
+    def _store(etag, body_gz):
+        with lock:
+            if etag in cache:
+                return
+            cache[etag] = body_gz
+            size[0] += len(body_gz)
+            while size[0] > max_bytes and cache:
+                size[0] -= len(cache.popitem(last=False)[1])
+
+    @server.before_request
+    def _serve_cached():
+        if not _is_update():
+            return None
+        if auth is not None and not auth.is_authorized():
+            return None
+        body = flask.request.get_data(cache=True)
+        etag = hashlib.sha1(version.encode() + b'\0' + body).hexdigest()
+        flask.g.response_etag = etag
+        body_gz = _lookup(etag)
+        if body_gz is None:
+            return None
+        flask.g.response_cached = True
+        if etag in flask.request.if_none_match:
+            response = flask.Response(status=304)
+        elif _accepts_gzip():
+            response = flask.Response(body_gz, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = flask.Response(gzip.decompress(body_gz),
+                                      mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    @server.after_request
+    def _compress_and_store(response):
+        etag = flask.g.get('response_etag')
+        if (etag is None or flask.g.get('response_cached') or
+                response.status_code != 200 or response.direct_passthrough or
+                'Content-Encoding' in response.headers):
+            return response
+        body = response.get_data()
+        body_gz = gzip.compress(body, compresslevel)
+        _store(etag, body_gz)
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        if _accepts_gzip() and len(body) >= min_size:
+            response.set_data(body_gz)
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    return cache
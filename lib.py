@@ -4,6 +4,9 @@
 Python library for interactive webapp
 """
 
+import re
+import warnings
+from collections import OrderedDict
 import numpy as np
 from scipy import stats
 import pandas as pd
@@ -29,6 +32,15 @@ for color in list_colors:
     color_rgb += str(color[2] * 255) + ')'
     list_colors_rgb.append(color_rgb)
 
+# Define (level 0) column groups of monthly series
+monthly_groups = ['kWh', 'kWhOn', 'kWhSemi', 'kWhOff',
+                  'kW', 'kWOn', 'kWSemi',
+                  'Therms',
+                  'EUI_elec', 'EUI_gas', 'EUI_tot',
+                  'EUI_tot_mo_avg_2009_2015', 'EUI_tot_mo_avg_2013_2015',
+                  'EUI_elec_mo_avg_2009_2015', 'EUI_elec_mo_avg_2013_2015',
+                  'EUI_gas_mo_avg_2009_2015', 'EUI_gas_mo_avg_2013_2015']
+
 
 def to_options(iterables):
     if isinstance(iterables, list):
@@ -52,35 +64,53 @@ def name_iou(all_iou):
     return ', '.join([mapping[iou] for iou in all_iou.split(',')])
 
 
-def read_processed_bills(file, multi_index=True, dtype=None):
+def get_bldg_info(bldg):
+    """Summarize attributes of a building (row of bills) as ordered (label,
+    text) pairs"""
+    # Define field of variables
+    EUI_field = ('summary', 'EUI_tot_avg_2009_2015')
+    trend_field = ('summary', 'EUI_tot_fit_2009_2015_slope')
+    year_field = ('cis', 'year_built')
+    area_field = ('cis', 'building_area')
+    address = (bldg['cis']['address'].title() + ', ' +
+               bldg['cis']['city'].title() + ', CA ' + str(bldg['cis']['zip']))
+    # Define text
+    info = OrderedDict()
+    info['Address'] = address
+    info['Utility'] = name_iou(bldg['cis']['iou'])
+    info['Building type'] = bldg['cis']['building_type']
+    info['Climate zone'] = str(bldg['cis']['cz'])
+    info['6-year average annual EUI'] = '{:.1f} kBTU/ft²'.format(bldg[EUI_field])
+    info['Change in annual EUI over 6 years'] = '{:.1f} kBTU/ft²/year'.format(bldg[trend_field])
+    info['Year built'] = '{}'.format(int(bldg[year_field]))
+    info['Floor area'] = '{:,.0f} ft²'.format(bldg[area_field])
+    return info
+
+
+def link_map(address):
+    return 'https://www.google.com/maps/place/' + address.replace(' ', '+')
+
+
+def read_processed_bills(file, multi_index=True, dtype=None, compact=False):
     """Function to read processed bills after merging and transformation. Same
-    as utilib.read.read_processed_bills()"""
+    as utilib.read.read_processed_bills(). If compact is True, monthly series
+    are stored as float32 and cis attributes as categoricals (see
+    compact_bills())"""
     if multi_index:
         header = [0, 1]
     else:
         header = None
 
     # Define dtypes for all possible (level 0) columns
-    dtype = {'cis': str,
-             'kWh': np.float64,
-             'kWhOn': np.float64,
-             'kWhSemi': np.float64,
-             'kWhOff': np.float64,
-             'kW': np.float64,
-             'kWOn': np.float64,
-             'kWSemi': np.float64,
-             'billAmnt': np.float64,
-             'Therms': np.float64,
-             'EUI_elec': np.float64,
-             'EUI_gas': np.float64,
-             'EUI_tot': np.float64,
-             'EUI_tot_mo_avg_2009_2015': np.float64,
-             'EUI_tot_mo_avg_2013_2015': np.float64,
-             'EUI_elec_mo_avg_2009_2015': np.float64,
-             'EUI_elec_mo_avg_2013_2015': np.float64,
-             'EUI_gas_mo_avg_2009_2015': np.float64,
-             'EUI_gas_mo_avg_2013_2015': np.float64,
-             'summary': np.float64}
+    if compact:
+        monthly_dtype = np.float32
+    else:
+        monthly_dtype = np.float64
+    group_dtype = {'cis': str,
+                   'billAmnt': np.float64,
+                   'summary': np.float64}
+    for group in monthly_groups:
+        group_dtype[group] = monthly_dtype
     # Define all possible (level 1) columns under cis to be converted to float
     col_to_float = ['Longitude', 'Latitude',
                     'year_built', 'year_renovated',
@@ -93,6 +123,20 @@ def read_processed_bills(file, multi_index=True, dtype=None):
     # boolean
     col_to_bool = ['range_address_ind']
 
+    # Expand dtypes to all (level 0, level 1) columns since the parser ignores
+    # level 0 keys with a multi-level header, so that monthly series are parsed
+    # directly into their final dtype
+    if multi_index:
+        columns = pd.read_csv(file, header=header, nrows=0).columns
+        dtype = {}
+        for col in columns:
+            if col[0] == 'cis' and col[1] in col_to_float:
+                dtype[col] = np.float64
+            elif col[0] in group_dtype:
+                dtype[col] = group_dtype[col[0]]
+    else:
+        dtype = group_dtype
+
     # Read file
     df = pd.read_csv(file, header=header, dtype=dtype)
 
@@ -113,65 +157,444 @@ def read_processed_bills(file, multi_index=True, dtype=None):
         if full_col in df:
             df.loc[:, full_col] = df.loc[:, full_col].astype(bool)
 
+    if compact:
+        df = compact_bills(df, exclude=col_to_float + col_to_time + col_to_bool)
+
     return df
 
 
+def compact_bills(df, max_frac_unique=0.5, exclude=None):
+    """Function to reduce the memory footprint of bills. Monthly series are
+    downcast to float32 and cis attributes with fewer than max_frac_unique *
+    len(df) unique values are converted to categoricals. df is converted in
+    place (and returned) so that no extra copy of it is held"""
+    if exclude is None:
+        exclude = []
+    for col in df.columns:
+        if col[0] in monthly_groups:
+            if df[col].dtype != np.float32:
+                df[col] = df[col].astype(np.float32)
+        elif col[0] == 'cis' and col[1] not in exclude:
+            is_str = (pd.api.types.is_object_dtype(df[col]) or
+                      pd.api.types.is_string_dtype(df[col]))
+            if is_str and df[col].nunique() < max_frac_unique * len(df):
+                df[col] = df[col].astype('category')
+    return df
+
+
+def memory_footprint(df):
+    """Report memory footprint (in MB) of bills per (level 0) column group"""
+    usage = df.memory_usage(deep=True, index=False)
+    dtypes = df.dtypes.astype(str)
+    report = pd.DataFrame({'n_columns': usage.groupby(level=0).size(),
+                           'dtypes': dtypes.groupby(level=0).apply(
+                               lambda x: ', '.join(sorted(set(x)))),
+                           'MB': usage.groupby(level=0).sum() / 2**20})
+    report = report.sort_values('MB', ascending=False)
+    report.loc['total'] = [report['n_columns'].sum(), '', report['MB'].sum()]
+    return report
+
+
+def _compare_values(full, compact, decimals, rtol):
+    """Compare float64 and compact values within half a display unit or rtol
+    relative to the float64 value, whichever is larger"""
+    full = np.asarray(full, dtype=np.float64)
+    compact = np.asarray(compact, dtype=np.float64)
+    error = np.abs(full - compact)
+    tol = np.fmax(0.5 * 10**-decimals, rtol * np.abs(full))
+    differ = (error > tol) | (np.isnan(full) != np.isnan(compact))
+    return {'max_abs_error': np.nanmax(error) if np.isfinite(error).any() else 0.,
+            'n_diff': int(np.sum(differ))}
+
+
+def check_compact_accuracy(df, df_compact, decimals=1, rtol=1e-5):
+    """Check that a compact df (see compact_bills()) gives the same results as
+    the float64 df to display precision, i.e. within half a unit of the
+    decimals-th digit or rtol relative to the value (for large values such as
+    raw kWh). Compared are the stored monthly values, the peer traces (see
+    get_peer_traces()), the anomaly scores and flags (see scan_anomalies())
+    and the members of each building type x climate zone group, as used by
+    plot_box() and plot_bldg_hist(). Returns the max absolute error, the
+    number of values (or flags, or groups) that differ and whether there are
+    none for each check"""
+    results = OrderedDict()
+    # Stored monthly values
+    for group in monthly_groups:
+        if group in df.columns.get_level_values(0):
+            results[group] = _compare_values(df[group].values,
+                                             df_compact[group].values,
+                                             decimals, rtol)
+    # Peer traces
+    peers = get_peer_traces(df)
+    peers_compact = get_peer_traces(df_compact).reindex(index=peers.index,
+                                                        columns=peers.columns)
+    results['peer traces'] = _compare_values(peers.values,
+                                             peers_compact.values,
+                                             decimals, rtol)
+    # Anomaly scores and flags
+    scores = scan_anomalies(df)
+    scores_compact = scan_anomalies(df_compact)
+    for col in scores.columns:
+        result = _compare_values(scores[col].values, scores_compact[col].values,
+                                 decimals, rtol)
+        if col[1].endswith('_anom_score'):
+            result['n_diff'] = int(np.sum((scores[col] >= 1).values !=
+                                          (scores_compact[col] >= 1).values))
+        results[col[1]] = result
+    # Members of building type x climate zone groups
+    keys = [('cis', 'building_type'), ('cis', 'cz')]
+    members = df[keys].astype(str).apply(tuple, axis=1)
+    members_compact = df_compact[keys].astype(str).apply(tuple, axis=1)
+    n_diff = len(set(members[members.values != members_compact.values]) |
+                 set(members_compact[members.values != members_compact.values]))
+    results['building type x cz groups'] = {'max_abs_error': 0.,
+                                            'n_diff': n_diff}
+    report = pd.DataFrame(results).T
+    report['n_diff'] = report['n_diff'].astype(int)
+    report['passed'] = report['n_diff'] == 0
+    return report[['max_abs_error', 'n_diff', 'passed']]
+
+
+def _compile_predicate(col, op, arg):
+    """Compile a predicate over a column into a function evaluating it on the
+    rows at given positions (all rows if None) of the typed column array"""
+    # Evaluate predicates on categoricals once per category and look up the
+    # result by code (code -1 for nan is looked up in the last element)
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        categories = pd.Series(col.cat.categories)
+        hit = np.append(_compile_predicate(categories, op, arg)(None),
+                        op == 'isnull')
+        codes = col.cat.codes.values
+        return lambda pos: hit[codes if pos is None else codes[pos]]
+
+    values = col.values
+    is_numeric = (pd.api.types.is_numeric_dtype(col.dtype) and
+                  not pd.api.types.is_bool_dtype(col.dtype))
+    if op == 'in':
+        if is_numeric:
+            wanted = []
+            for item in arg:
+                try:
+                    wanted.append(float(item))
+                except (TypeError, ValueError):
+                    pass
+            wanted = np.array(wanted)
+
+            def test(v):
+                return np.isin(v, wanted)
+        else:
+            wanted = [str(item) for item in arg]
+
+            def test(v):
+                return pd.Series(v).isin(wanted).values
+    elif op == 'between':
+        lo, hi = arg
+        if not is_numeric:
+            values = pd.to_numeric(col, errors='coerce').values
+
+        def test(v):
+            result = pd.notnull(v)
+            with np.errstate(invalid='ignore'):
+                if lo is not None:
+                    result &= v >= lo
+                if hi is not None:
+                    result &= v <= hi
+            return result
+    elif op == 'iou':
+        # Match any of the IOUs in comma-separated lists of IOUs
+        pattern = '(?:^|,)\\s*(?:{})\\s*(?:,|$)'.format(
+            '|'.join(re.escape(str(item)) for item in arg))
+
+        def test(v):
+            if len(arg) == 0:
+                return np.zeros(len(v), dtype=bool)
+            return pd.Series(v).astype(object).str.contains(
+                pattern, na=False).values.astype(bool)
+    elif op == 'isnull':
+        test = pd.isnull
+    elif op == 'notnull':
+        test = pd.notnull
+    else:
+        raise ValueError('Unknown predicate operator: ' + str(op))
+    return lambda pos: np.asarray(test(values if pos is None
+                                       else values[pos]), dtype=bool)
+
+
+def query(df, predicates, sample_size=1000):
+    """Function to find rows of df satisfying all predicates. Each predicate
+    is a tuple (key, op, arg) where key is a (group, column) key of df and op
+    is one of
+    - 'in': value in the list of values arg
+    - 'between': arg[0] <= value <= arg[1], where None means unbounded
+    - 'isnull'/'notnull': value is (not) missing (arg is ignored)
+    - 'iou': comma-separated list of IOUs contains any of the IOUs in arg
+    Values in arg are converted to the type of the column. Predicates are
+    evaluated in order of selectivity, as estimated on a sample of
+    sample_size rows, each on the rows remaining after the previous ones.
+    Returns the positions of the rows found"""
+    n = len(df)
+    compiled = [_compile_predicate(df[key], op, arg)
+                for key, op, arg in predicates]
+    # Estimate selectivity of predicates on evenly spaced sample of rows
+    if len(compiled) > 1 and n > 0:
+        sample = np.unique(np.linspace(0, n - 1, min(n, sample_size),
+                                       dtype=np.int64))
+        compiled.sort(key=lambda predicate: predicate(sample).mean())
+    # Evaluate predicates, most selective first
+    pos = None
+    for predicate in compiled:
+        keep = predicate(pos)
+        pos = np.flatnonzero(keep) if pos is None else pos[keep]
+        if len(pos) == 0:
+            break
+    if pos is None:
+        pos = np.arange(n)
+    return pos
+
+
 def get_group(df, building_type=None, cz=None, other=None):
     """Function to extract group of specific building type and/or climate
-    zone and/or other attributes. Same as utilib.plot.get_group()"""
-    ind = pd.Series(True, index=df.index)
+    zone and/or other attributes. Same as utilib.plot.get_group(). Values of
+    other can also be a dict of {op: arg} predicates (see query())"""
+    predicates = []
     if building_type is not None:
         if isinstance(building_type, str):
             building_type = [building_type]
-        ind = ind & (df[('cis', 'building_type')].isin(building_type))
+        predicates.append((('cis', 'building_type'), 'in', building_type))
     if cz is not None:
-        if np.issubdtype(type(cz), np.integer) or isinstance(cz, str):
+        if np.isscalar(cz):
             cz = [cz]
-        cz = [str(item) for item in cz]
-        ind = ind & (df[('cis', 'cz')].isin(cz))
+        predicates.append((('cis', 'cz'), 'in', cz))
     if other is not None:
         for key in other:
-            if np.issubdtype(type(other[key]),
-                             np.integer) or isinstance(other[key], str):
-                value = [other[key]]
+            if isinstance(other[key], dict):
+                for op in other[key]:
+                    predicates.append((key, op, other[key][op]))
             else:
-                value = other[key]
-            value = [str(item) for item in value]
-            ind = ind & df[key].isin(value)
-    return df[ind]
+                if np.isscalar(other[key]):
+                    value = [other[key]]
+                else:
+                    value = other[key]
+                predicates.append((key, 'in', value))
+    return df.iloc[query(df, predicates)]
 
 
 def filter_bldg(df, types_tf, cz_tf, iou_tf, fuel=None,
                 consumption_range=None, value=None,
                 year_tf=None, year_lim=None,
-                area_tf=None, area_lim=None):
+                area_tf=None, area_lim=None,
+                anom_field=None, anom_min=None):
     # Make sure types_tf is a list since multi dropmenu could result in str
     if not isinstance(types_tf, list):
-        list_types_tf = list(types_tf)
+        list_types_tf = [types_tf]
     else:
         list_types_tf = types_tf
-    # Filter by building types and cz
-    index = (df['cis']['building_type'].isin(list_types_tf) &
-             df['cis']['cz'].isin(cz_tf))
-    # Filter by iou
-    index_iou = pd.Series([False] * len(index))
-    for iou in iou_tf:
-        index_iou = index_iou | (df['cis']['iou'].str.contains(iou))
-    index = index & index_iou
+    # Filter by building types, cz and iou
+    predicates = [(('cis', 'building_type'), 'in', list_types_tf),
+                  (('cis', 'cz'), 'in', cz_tf),
+                  (('cis', 'iou'), 'iou', iou_tf)]
     # Filter by fuel type
     # Filter by year built range
     if not ((year_tf[0] == year_lim[0]) and (year_tf[1] == year_lim[1])):
-        index = index & ((df['cis']['year_built'] >= year_tf[0]) &
-                         (df['cis']['year_built'] <= year_tf[1]))
+        predicates.append((('cis', 'year_built'), 'between', year_tf))
     # Filter by building area
     if (area_tf[0] == area_lim[0]) and not (area_tf[1] == area_lim[1]):
-        index = index & (df['cis']['building_area'] <= area_tf[1])
+        predicates.append((('cis', 'building_area'), 'between',
+                           (None, area_tf[1])))
     elif not (area_tf[0] == area_lim[0]) and (area_tf[1] == area_lim[1]):
-        index = index & (df['cis']['building_area'] >= area_tf[0])
+        predicates.append((('cis', 'building_area'), 'between',
+                           (area_tf[0], None)))
     elif not ((area_tf[0] == area_lim[0]) and (area_tf[1] == area_lim[1])):
-        index = index & ((df['cis']['building_area'] >= area_tf[0]) &
-                         (df['cis']['building_area'] <= area_tf[1]))
-    return df[index]
+        predicates.append((('cis', 'building_area'), 'between', area_tf))
+    # Filter by anomaly score
+    if anom_min is not None:
+        predicates.append((('summary', anom_field), 'between',
+                           (anom_min, None)))
+    return df.iloc[query(df, predicates)]
+
+
+def _robust_scale(x, axis=1):
+    """Estimate standard deviation along axis from the median absolute
+    deviation, ignoring nan"""
+    med = np.nanmedian(x, axis=axis, keepdims=True)
+    return 1.4826 * np.nanmedian(np.abs(x - med), axis=axis)
+
+
+def _scan_monthly(x, months, window, zero_tol):
+    """Compute step, spike and zero run statistics of a (building x month)
+    matrix of monthly traces in one vectorized pass"""
+    n, m = x.shape
+    valid = np.isfinite(x)
+    with np.errstate(invalid='ignore', divide='ignore'), \
+            warnings.catch_warnings():
+        # Ignore all-nan slices from buildings without data
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        # Noise level from year-over-year differences, which cancel out
+        # seasonality and are only affected by a step for one year
+        noise = _robust_scale(x[:, 12:] - x[:, :-12]) / np.sqrt(2)
+        floor = 0.01 * np.nanmedian(np.abs(x), axis=1)
+        noise = np.fmax(noise, floor)
+        noise[noise == 0] = np.nan
+
+        # Step change: difference between the means of the windows before and
+        # after each month, from cumulative sums along months. Not defined for
+        # traces shorter than two windows
+        if m >= 2 * window:
+            csum = np.zeros((n, m + 1))
+            csum[:, 1:] = np.cumsum(np.where(valid, x, 0), axis=1)
+            ccount = np.zeros((n, m + 1))
+            ccount[:, 1:] = np.cumsum(valid, axis=1)
+            sums = csum[:, window:] - csum[:, :-window]
+            counts = ccount[:, window:] - ccount[:, :-window]
+            means = sums / counts
+            diff = means[:, window:] - means[:, :-window]
+            step = (np.nanmax(np.abs(diff), axis=1) /
+                    (noise * np.sqrt(2 / window)))
+        else:
+            step = np.full(n, np.nan)
+
+        # Spike: robust z-score of residuals from the seasonal profile. The
+        # profile of each month is the mean of the same calendar month in the
+        # other years (leave-one-out), so that residuals are never zero by
+        # construction and the spike itself does not enter its own profile
+        resid = np.full_like(x, np.nan)
+        for month in range(1, 13):
+            cols = months == month
+            x_month = x[:, cols]
+            valid_month = valid[:, cols]
+            total = np.where(valid_month, x_month, 0).sum(axis=1, keepdims=True)
+            count = valid_month.sum(axis=1, keepdims=True)
+            resid[:, cols] = x_month - (total - x_month) / (count - 1)
+        resid_scale = np.fmax(_robust_scale(resid), floor)
+        resid_scale[resid_scale == 0] = np.nan
+        resid = resid - np.nanmedian(resid, axis=1, keepdims=True)
+        spike = np.nanmax(np.abs(resid), axis=1) / resid_scale
+
+    # Zero run: longest run of consecutive months with zero consumption, only
+    # counting months in which the building normally consumes (non-zero
+    # median of the same calendar month over years), so that seasonal zeros
+    # (e.g. no gas in summer) and traces without the fuel are not counted
+    is_zero = np.abs(np.where(valid, x, np.inf)) <= zero_tol
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for month in range(1, 13):
+            cols = months == month
+            typical = np.nanmedian(x[:, cols], axis=1, keepdims=True)
+            is_zero[:, cols] &= np.abs(typical) > zero_tol
+    cum_zero = np.cumsum(is_zero, axis=1)
+    last_reset = np.maximum.accumulate(np.where(is_zero, 0, cum_zero), axis=1)
+    zero = (cum_zero - last_reset).max(axis=1)
+
+    return (np.nan_to_num(step, nan=0.0), np.nan_to_num(spike, nan=0.0),
+            zero.astype(np.float64))
+
+
+def scan_anomalies(df, fuels=('tot', 'elec', 'gas'), window=12, zero_tol=0,
+                   step_thresh=6.5, spike_thresh=7.5, zero_thresh=3,
+                   chunksize=100000):
+    """Scan the monthly EUI traces of all buildings for step changes (e.g.
+    retrofits), spikes (e.g. meter faults) and runs of zero consumption (e.g.
+    vacancies). Returns a df with 'summary' columns EUI_<fuel>_anom_step (max
+    z-score of the difference between the means of the window months before
+    and after any month), EUI_<fuel>_anom_spike (max robust z-score of the
+    deseasonalized trace), EUI_<fuel>_anom_zero (longest run of zero months)
+    and EUI_<fuel>_anom_score (max of the three statistics relative to their
+    threshold, so that buildings with score >= 1 are flagged). The default
+    thresholds flag about 1 in 100,000 buildings whose traces are seasonal
+    profiles plus Gaussian noise. The step statistic is 0 for traces shorter
+    than 2 * window months. Zero months only count towards zero runs in
+    calendar months in which the building normally consumes. Buildings are processed in chunks of chunksize
+    rows to bound memory usage"""
+    scores = OrderedDict()
+    for fuel in fuels:
+        field = 'EUI_' + fuel
+        if field not in df.columns.get_level_values(0):
+            continue
+        group = df[field]
+        cols = sorted(group.columns)
+        months = np.array([int(col.split('-')[1]) for col in cols])
+        stats_fuel = {'step': [], 'spike': [], 'zero': []}
+        x_all = group[cols].values
+        for start in range(0, len(df), chunksize):
+            x = x_all[start:start + chunksize]
+            step, spike, zero = _scan_monthly(x.astype(np.float64), months,
+                                              window, zero_tol)
+            stats_fuel['step'].append(step)
+            stats_fuel['spike'].append(spike)
+            stats_fuel['zero'].append(zero)
+        for stat in ['step', 'spike', 'zero']:
+            scores[('summary', field + '_anom_' + stat)] = \
+                np.concatenate(stats_fuel[stat])
+        scores[('summary', field + '_anom_score')] = np.maximum.reduce(
+            [scores[('summary', field + '_anom_step')] / step_thresh,
+             scores[('summary', field + '_anom_spike')] / spike_thresh,
+             scores[('summary', field + '_anom_zero')] / zero_thresh])
+    df_scores = pd.DataFrame(scores, index=df.index)
+    df_scores.columns = pd.MultiIndex.from_tuples(df_scores.columns)
+    return df_scores
+
+
+def get_peer_traces(df, fuels=('tot', 'elec', 'gas'),
+                    quantiles=(0.25, 0.5, 0.75)):
+    """Precompute quantiles of the monthly EUI traces (full and average
+    monthly) of each building type and climate zone in one grouped pass.
+    Returns a df indexed by (building_type, cz, quantile) with the same
+    columns as the traces in df"""
+    fields = [field for field in df.columns.get_level_values(0).unique()
+              if any(field == 'EUI_' + fuel or
+                     field.startswith('EUI_' + fuel + '_mo_avg')
+                     for fuel in fuels)]
+    keys = [df[('cis', 'building_type')].astype(str).values,
+            df[('cis', 'cz')].astype(str).values]
+    return df[fields].groupby(keys).quantile(list(quantiles))
+
+
+def _peer_band(peers, building, field, x, index, color_i, name):
+    """Define traces of the median and the band between the lowest and highest
+    quantiles in peers (see get_peer_traces()) of the peers of a building"""
+    key = (str(building[('cis', 'building_type')]),
+           str(building[('cis', 'cz')]))
+    try:
+        group = peers.loc[key]
+    except KeyError:
+        # No peers of the same building type and climate zone
+        return []
+    group = group[field].T.reindex(index)
+    quantiles = sorted(group.columns)
+    color = list_colors[color_i]
+    fillcolor = 'rgba({:.0f},{:.0f},{:.0f},0.2)'.format(color[0] * 255,
+                                                        color[1] * 255,
+                                                        color[2] * 255)
+    data = []
+    if len(quantiles) > 1:
+        q_lo = quantiles[0]
+        q_hi = quantiles[-1]
+        data.append(go.Scatter(x=x, y=group[q_lo],
+                               mode='lines',
+                               line={'width': 0},
+                               hoverinfo='skip',
+                               legendgroup=name + ' peers',
+                               showlegend=False))
+        data.append(go.Scatter(x=x, y=group[q_hi],
+                               mode='lines',
+                               line={'width': 0},
+                               fill='tonexty',
+                               fillcolor=fillcolor,
+                               hoverinfo='skip',
+                               legendgroup=name + ' peers',
+                               name='{} peers {:g}-{:g}%'.format(name,
+                                                                q_lo * 100,
+                                                                q_hi * 100),
+                               showlegend=True))
+    if 0.5 in quantiles:
+        data.append(go.Scatter(x=x, y=group[0.5],
+                               mode='lines',
+                               line={'color': list_colors_rgb[color_i + 1],
+                                     'width': 2,
+                                     'dash': 'dash'},
+                               name=name + ' peer median',
+                               showlegend=True))
+    return data
 
 
 def plot_box(df, by, selection, value,
@@ -237,7 +660,10 @@ def plot_box(df, by, selection, value,
     return {'data': data, 'layout': layout}
 
 
-def plot_bldg_full_timetrace(df, i, fuel='all'):
+def plot_bldg_full_timetrace(df, i, fuel='all', peers=None):
+    """Plot the full monthly EUI trace of a building by specified fuel types,
+    overlaid on the median and quantile band of its peers if peers (see
+    get_peer_traces()) is given"""
     # Parse building info
     building = df.iloc[i]
     # Define fuel types
@@ -261,6 +687,10 @@ def plot_bldg_full_timetrace(df, i, fuel='all'):
         field = 'EUI_' + fuel
         trace = building[field]
         yr_mo = pd.to_datetime(trace.index)
+        if peers is not None:
+            data.extend(_peer_band(peers, building, field,
+                                   yr_mo, trace.index, color_i,
+                                   terms[fuel].title()))
         curr_trace = go.Scatter(x=yr_mo,
                                 y=trace,
                                 mode='lines',
@@ -278,8 +708,10 @@ def plot_bldg_full_timetrace(df, i, fuel='all'):
     return {'data': data, 'layout': layout}
 
 
-def plot_bldg_avg_monthly(df, i, fuel='all', year_range=None):
-    """Plot the average monthly EUI of a building by specified fuel types"""
+def plot_bldg_avg_monthly(df, i, fuel='all', year_range=None, peers=None):
+    """Plot the average monthly EUI of a building by specified fuel types,
+    overlaid on the median and quantile band of its peers if peers (see
+    get_peer_traces()) is given"""
     # Parse building info
     building = df.iloc[i]
     # Define fuel types
@@ -328,6 +760,10 @@ def plot_bldg_avg_monthly(df, i, fuel='all', year_range=None):
                                          'width': 2},
                                    opacity=alpha,
                                    showlegend=False))
+        if peers is not None:
+            data.extend(_peer_band(peers, building, field_avg_mo,
+                                   months, bldg_mean_trace.index, color_i,
+                                   terms[fuel].title()))
         data.append(go.Scatter(x=months,
                                y=bldg_mean_trace,
                                mode='lines',
@@ -409,8 +845,8 @@ def plot_map(df, colorby_value=None, value=None):
     #EUI_field = ('summary', 'EUI_tot_avg_2009_2015')
     EUI_field = ('summary', value)
     text = df['cis']['address'].str.title() + ', ' + df['cis']['city'].str.title()
-    text = text + '<br>' + df['cis']['building_type']
-    text = text + '<br>Climate zone ' + df['cis']['cz']
+    text = text + '<br>' + df['cis']['building_type'].astype(str)
+    text = text + '<br>Climate zone ' + df['cis']['cz'].astype(str)
     text = text + df[EUI_field].apply('<br>Avg annual EUI = {:.1f} kBtu/ft²'.format)
     text = text + df['cis']['year_built'].apply('<br>Year built = {:.0f}'.format)
     text = text + df['cis']['building_area'].apply('<br>Building area = {:,.0f} ft²'.format)
@@ -419,6 +855,10 @@ def plot_map(df, colorby_value=None, value=None):
     if colorby_value == 'Consumption':
         color = np.log(df[EUI_field])
         colorscale = 'YlOrBr'
+    elif colorby_value == 'Anomaly':
+        fuel = value.split('_')[1]
+        color = df[('summary', 'EUI_' + fuel + '_anom_score')]
+        colorscale = 'Reds'
     elif colorby_value == 'Year built':
         color = df['cis']['year_built']
         colorscale = 'hot'
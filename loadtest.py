@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+'''
+Load test of the web app by replaying dashboard sessions concurrently
+
+Usage:
+
+* To generate a synthetic data file for running the app offline, type the
+  following in the terminal:
+    > python loadtest.py --write-synthetic synthetic.csv --n-bldgs 5000
+  and start the app with it:
+    > python app.py synthetic.csv
+
+* To replay 50 concurrent synthesized sessions against the running app, type
+  the following in the terminal:
+    > python loadtest.py --url http://localhost:80 --user name --password pw --users 50 --n-bldgs 5000
+  where name and pw are a username and password in auth.csv. Each session is
+  a sequence of steps such as changing the building types, dragging the year
+  built slider, clicking a building on the map and switching the statistics,
+  and each step posts the callbacks it triggers to /_dash-update-component.
+  Latency percentiles, throughput and error rates are reported per callback.
+
+* Add --save-sessions sessions.json to save the synthesized sessions, and
+  --sessions sessions.json to replay saved (or hand-written) sessions instead.
+
+Anthony Ho <anthony.ho@energy.ca.gov>
+'''
+
+
+import sys
+import time
+import json
+import base64
+import random
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+# Define names and options for filtering/metrics as in app.py
+list_types = ['Warehouse', 'Distribution',
+              'Office building', 'Medical building',
+              'Hospital / convalescent home', 'Hotel / motel',
+              'Shopping center', 'Department store / retail outlet',
+              'Food store / supermarket', 'Storefront retail',
+              'Miscell commercial']
+list_cz = [str(cz) for cz in range(1, 17)]
+list_iou = ['pge', 'sce', 'scg', 'sdge']
+list_colorby = ['Building type', 'Climate zone',
+                'IOU', 'Fuel type',
+                'Consumption', 'Year built', 'Building area', 'Anomaly']
+min_year = 1900
+max_year = 2015
+min_area = 50000
+max_area = 500000
+
+# Define inputs of each callback of app.py as (id, property)
+filter_inputs = [('filter_types', 'value'),
+                 ('filter_cz', 'values'),
+                 ('filter_iou', 'values'),
+                 ('filter_year', 'value'),
+                 ('filter_area', 'value'),
+                 ('filter_fuel', 'value'),
+                 ('filter_value', 'value'),
+                 ('metric_unit', 'value'),
+                 ('metric_fuel', 'value'),
+                 ('metric_stat', 'value')]
+callbacks = {('map', 'figure'): filter_inputs + [('colorby', 'value'),
+                                                 ('filter_anom', 'value')],
+             ('boxplot', 'figure'): filter_inputs + [('filter_anom', 'value')],
+             ('building_info', 'children'): [('map', 'clickData')],
+             ('fulltrace', 'figure'): [('map', 'clickData')],
+             ('avg_monthly', 'figure'): [('map', 'clickData')],
+             ('hist_avg', 'figure'): [('map', 'clickData')],
+             ('hist_trend', 'figure'): [('map', 'clickData')]}
+default_state = {'filter_types': ['Office building'],
+                 'filter_cz': list_cz,
+                 'filter_iou': list_iou,
+                 'filter_year': [min_year, max_year],
+                 'filter_area': [min_area, max_area],
+                 'filter_fuel': 'both',
+                 'filter_value': [0, 1000],
+                 'metric_unit': 'EUI',
+                 'metric_fuel': 'tot',
+                 'metric_stat': 'avg',
+                 'colorby': 'Consumption',
+                 'filter_anom': 'all',
+                 'map': None}
+
+
+def make_synthetic_bills(n_bldgs=1000, seed=0):
+    """Generate a synthetic data file in the format of processed bills with all
+    columns used by the app"""
+    rng = np.random.RandomState(seed)
+    list_yr_mo = ['{}-{:02d}'.format(year, month)
+                  for year in range(2009, 2016) for month in range(1, 13)]
+    seasonal = 1 + 0.3 * np.sin(np.arange(len(list_yr_mo)) / 12 * 2 * np.pi)
+    cols = {}
+    cols[('cis', 'address')] = ['{} main st'.format(i) for i in range(n_bldgs)]
+    cols[('cis', 'city')] = rng.choice(['sacramento', 'fresno', 'san diego',
+                                        'los angeles', 'oakland'], n_bldgs)
+    cols[('cis', 'zip')] = rng.randint(90001, 96162, n_bldgs).astype(str)
+    cols[('cis', 'building_type')] = rng.choice(list_types, n_bldgs)
+    cols[('cis', 'cz')] = rng.choice(list_cz, n_bldgs)
+    cols[('cis', 'iou')] = rng.choice(['pge', 'pge,scg', 'sce', 'sce,scg',
+                                       'sdge'], n_bldgs)
+    cols[('cis', 'year_built')] = rng.randint(min_year, max_year + 1,
+                                              n_bldgs).astype(float)
+    cols[('cis', 'building_area')] = rng.uniform(min_area / 2, max_area * 2,
+                                                 n_bldgs)
+    cols[('cis', 'Latitude')] = rng.uniform(32.5, 42, n_bldgs)
+    cols[('cis', 'Longitude')] = rng.uniform(-124, -114.5, n_bldgs)
+    traces = {}
+    for fuel in ['elec', 'gas']:
+        level = rng.lognormal(1, 0.5, (n_bldgs, 1))
+        traces[fuel] = level * seasonal + rng.normal(0, 0.1, (n_bldgs,
+                                                             len(list_yr_mo)))
+    traces['tot'] = traces['elec'] + traces['gas']
+    for fuel in ['tot', 'elec', 'gas']:
+        for j, yr_mo in enumerate(list_yr_mo):
+            cols[('EUI_' + fuel, yr_mo)] = traces[fuel][:, j]
+        monthly = traces[fuel].reshape(n_bldgs, -1, 12)
+        for month in range(12):
+            cols[('EUI_' + fuel + '_mo_avg_2009_2015', str(month + 1))] = \
+                monthly[:, :, month].mean(axis=1)
+        annual = monthly.sum(axis=2)
+        cols[('summary', 'EUI_' + fuel + '_avg_2009_2015')] = annual.mean(axis=1)
+        cols[('summary', 'EUI_' + fuel + '_fit_2009_2015_slope')] = \
+            np.polyfit(np.arange(annual.shape[1]), annual.T, 1)[0]
+    df = pd.DataFrame(cols)
+    df.columns = pd.MultiIndex.from_tuples(df.columns)
+    return df
+
+
+def synthesize_session(rng, n_bldgs, n_steps=8):
+    """Synthesize a session as a list of steps, each a dict of the changed
+    component values"""
+    steps = [dict(default_state)]
+    for _ in range(n_steps):
+        action = rng.choice(['types', 'cz', 'year', 'click', 'click',
+                             'stat', 'fuel', 'colorby', 'area'])
+        if action == 'types':
+            step = {'filter_types': rng.sample(list_types, rng.randint(1, 4))}
+        elif action == 'cz':
+            step = {'filter_cz': sorted(rng.sample(list_cz,
+                                                   rng.randint(1, 16)), key=int)}
+        elif action == 'year':
+            start = rng.randrange(min_year, max_year, 5)
+            step = {'filter_year': [start, rng.randrange(start, max_year + 1, 5)]}
+        elif action == 'area':
+            start = rng.randrange(min_area, max_area, 10000)
+            step = {'filter_area': [start,
+                                    rng.randrange(start, max_area + 1, 10000)]}
+        elif action == 'click':
+            step = {'map': {'points': [{'customdata': rng.randrange(n_bldgs)}]}}
+        elif action == 'stat':
+            step = {'metric_stat': rng.choice(['avg', 'fit'])}
+        elif action == 'fuel':
+            step = {'metric_fuel': rng.choice(['tot', 'elec', 'gas'])}
+        elif action == 'colorby':
+            step = {'colorby': rng.choice(list_colorby)}
+        steps.append(step)
+    return steps
+
+
+def _requests_of_step(state, step):
+    """Get the callback payloads triggered by a step of a session"""
+    state.update(step)
+    payloads = []
+    for (output_id, output_prop), inputs in callbacks.items():
+        if not any(input_id in step for input_id, _ in inputs):
+            continue
+        payload = {'output': {'id': output_id, 'property': output_prop},
+                   'inputs': [{'id': input_id, 'property': input_prop,
+                               'value': state[input_id]}
+                              for input_id, input_prop in inputs],
+                   'state': []}
+        payloads.append((output_id, payload))
+    return payloads
+
+
+def run_session(url, headers, session, results, lock, timeout):
+    # Start from the initial state of the app so that sessions only need to
+    # list the components changed at each step
+    state = dict(default_state)
+    for step in session:
+        for output_id, payload in _requests_of_step(state, step):
+            request = urllib.request.Request(url,
+                                             data=json.dumps(payload).encode(),
+                                             headers=headers)
+            start = time.time()
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as r:
+                    r.read()
+                error = False
+            except Exception:
+                # Count any failure (e.g. HTTP errors, timeouts, incomplete
+                # reads) as an error of the callback
+                error = True
+            latency = time.time() - start
+            with lock:
+                results.append((output_id, latency, error))
+
+
+def report(results, elapsed):
+    """Summarize latency percentiles (in ms), throughput and error rate per
+    callback"""
+    df = pd.DataFrame(results, columns=['callback', 'latency', 'error'])
+    ok = df[~df['error']]
+    summary = pd.DataFrame({'requests': df.groupby('callback').size(),
+                            'error_pct': df.groupby('callback')['error'].mean() * 100,
+                            'p50_ms': ok.groupby('callback')['latency'].quantile(0.5) * 1000,
+                            'p95_ms': ok.groupby('callback')['latency'].quantile(0.95) * 1000,
+                            'p99_ms': ok.groupby('callback')['latency'].quantile(0.99) * 1000})
+    summary['req_per_s'] = summary['requests'] / elapsed
+    summary.loc['all'] = [len(df), df['error'].mean() * 100,
+                          ok['latency'].quantile(0.5) * 1000,
+                          ok['latency'].quantile(0.95) * 1000,
+                          ok['latency'].quantile(0.99) * 1000,
+                          len(df) / elapsed]
+    return summary
+
+
+def main():
+    description = 'Replay dashboard sessions concurrently against the web app'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--write-synthetic',
+                        help='write a synthetic data file to this path and exit')
+    parser.add_argument('--url', default='http://localhost:80',
+                        help='url of the running app')
+    parser.add_argument('--user', help='username in auth.csv')
+    parser.add_argument('--password', help='password in auth.csv')
+    parser.add_argument('--users', type=int, default=50,
+                        help='number of concurrent sessions')
+    parser.add_argument('--n-sessions', type=int, default=None,
+                        help='number of sessions to replay (default: --users)')
+    parser.add_argument('--n-steps', type=int, default=8,
+                        help='number of steps per synthesized session')
+    parser.add_argument('--n-bldgs', type=int, default=1000,
+                        help='number of buildings in the data file')
+    parser.add_argument('--sessions',
+                        help='json file of sessions to replay')
+    parser.add_argument('--save-sessions',
+                        help='save synthesized sessions to this json file')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='timeout of each request in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.write_synthetic:
+        make_synthetic_bills(args.n_bldgs, args.seed).to_csv(args.write_synthetic,
+                                                             index=False)
+        return
+
+    # Get sessions
+    if args.sessions:
+        with open(args.sessions) as f:
+            sessions = json.load(f)
+    else:
+        rng = random.Random(args.seed)
+        sessions = [synthesize_session(rng, args.n_bldgs, args.n_steps)
+                    for _ in range(args.n_sessions or args.users)]
+        if args.save_sessions:
+            with open(args.save_sessions, 'w') as f:
+                json.dump(sessions, f, indent=1)
+
+    # Replay sessions concurrently
+    url = args.url.rstrip('/') + '/_dash-update-component'
+    headers = {'Content-Type': 'application/json'}
+    if args.user is not None:
+        token = base64.b64encode('{}:{}'.format(args.user,
+                                                args.password).encode())
+        headers['Authorization'] = 'Basic ' + token.decode()
+    results = []
+    lock = threading.Lock()
+    start = time.time()
+    with ThreadPoolExecutor(args.users) as executor:
+        futures = [executor.submit(run_session, url, headers, session,
+                                   results, lock, args.timeout)
+                   for session in sessions]
+        # Raise errors of sessions other than failed requests
+        for future in futures:
+            future.result()
+    elapsed = time.time() - start
+
+    print('{} sessions, {} requests in {:.1f} s'.format(len(sessions),
+                                                         len(results), elapsed))
+    with pd.option_context('display.float_format', '{:.1f}'.format):
+        print(report(results, elapsed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+# Anthony Ho <anthony.ho@energy.ca.gov>
+"""
+Opt-in profiling of slow Dash callbacks
+"""
+
+import os
+import io
+import sys
+import time
+import pstats
+import cProfile
+import itertools
+import threading
+from collections import Counter
+import flask
+from http_cache import update_path
+
+
+def _output_name(request):
+    """Get name of the output of a callback request"""
+    payload = request.get_json(silent=True) or {}
+    output = payload.get('output', 'unknown')
+    if isinstance(output, dict):
+        output = '{}.{}'.format(output.get('id'), output.get('property'))
+    return ''.join(c if c.isalnum() or c in '._-' else '_'
+                   for c in str(output))[:100]
+
+
+def list_profiles(directory):
+    """List saved profiles, newest first"""
+    names = sorted((name for name in os.listdir(directory)
+                    if name.endswith('.prof') or name.endswith('.folded')),
+                   reverse=True)
+    return [{'name': name,
+             'size': os.path.getsize(os.path.join(directory, name))}
+            for name in names]
+
+
+def _summarize_folded(path, limit=50):
+    """Summarize a sampled profile in folded stack format by the number of
+    samples in which each line was running (self) or on the stack (total)"""
+    own = Counter()
+    total = Counter()
+    n_samples = 0
+    with open(path) as f:
+        for line in f:
+            stack, count = line.rsplit(' ', 1)
+            count = int(count)
+            frames = stack.split(';')
+            n_samples += count
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+    lines = ['{} samples\n'.format(n_samples),
+             '{:>8} {:>8}  {}'.format('self', 'total', 'file:function:line')]
+    for frame, count in total.most_common(limit):
+        lines.append('{:>8} {:>8}  {}'.format(own[frame], count, frame))
+    return '\n'.join(lines) + '\n'
+
+
+class _Sampler(object):
+    """Sample the stacks of registered threads at a fixed interval from a
+    background thread"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, ident):
+        counts = Counter()
+        with self.lock:
+            self.active[ident] = counts
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return counts
+
+    def stop(self, ident):
+        with self.lock:
+            return self.active.pop(ident, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, counts in self.active.items():
+                    frame = frames.get(ident)
+                    stack = []
+                    while frame is not None:
+                        stack.append('{}:{}:{}'.format(frame.f_code.co_filename,
+                                                       frame.f_code.co_name,
+                                                       frame.f_lineno))
+                        frame = frame.f_back
+                    if stack:
+                        counts[';'.join(reversed(stack))] += 1
+
+
+def enable_profiling(app, directory='profiles', threshold_ms=None,
+                     sample_every=None, max_profiles=100, auth=None,
+                     route='/_profiles', interval_ms=5):
+    """Function to profile callbacks of a Dash app. The profile of a callback
+    is saved to directory if it took longer than threshold_ms, or for every
+    sample_every-th callback. Since the duration of a callback is only known
+    once it ends, all callbacks are profiled if threshold_ms is set, using a
+    low-overhead sampling profiler that records the stack of each callback
+    every interval_ms (saved as .folded stacks, viewable with flamegraph
+    tools). Every sample_every-th callback is profiled with cProfile (saved as
+    .prof) instead, unless another callback is already being profiled with
+    cProfile, since cProfile cannot run concurrently, in which case it is
+    sampled too. Only the newest max_profiles profiles are kept. Profiles are
+    listed at route and downloaded at route/<name> (add ?format=txt for a text
+    summary). If auth (e.g. dash_auth.BasicAuth) is given, the listing and
+    downloads require authorization"""
+    server = app.server
+    os.makedirs(directory, exist_ok=True)
+    counter = itertools.count(1)
+    busy = threading.Lock()
+    sampler = _Sampler(interval_ms / 1000)
+
+    def _prune():
+        for profile in list_profiles(directory)[max_profiles:]:
+            try:
+                os.remove(os.path.join(directory, profile['name']))
+            except OSError:
+                pass
+
+    @server.before_request
+    def _start_profile():
+        if not (flask.request.method == 'POST' and
+                flask.request.path.endswith(update_path)):
+            return None
+        sampled = sample_every is not None and next(counter) % sample_every == 0
+        if threshold_ms is None and not sampled:
+            return None
+        profile = None
+        if sampled and busy.acquire(blocking=False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is already active
+                busy.release()
+                profile = None
+        if profile is None:
+            profile = sampler.start(threading.get_ident())
+        flask.g.profile = (profile, sampled, time.time())
+        return None
+
+    def _stop(profile):
+        if isinstance(profile, cProfile.Profile):
+            profile.disable()
+            busy.release()
+        else:
+            sampler.stop(threading.get_ident())
+
+    @server.after_request
+    def _stop_profile(response):
+        if flask.g.get('profile') is None:
+            return response
+        profile, sampled, start = flask.g.pop('profile')
+        _stop(profile)
+        elapsed_ms = (time.time() - start) * 1000
+        if sampled or (threshold_ms is not None and elapsed_ms >= threshold_ms):
+            name = '{:.6f}_{}_{:.0f}ms'.format(time.time(),
+                                               _output_name(flask.request),
+                                               elapsed_ms)
+            path = os.path.join(directory, name)
+            if isinstance(profile, cProfile.Profile):
+                profile.dump_stats(path + '.prof')
+            else:
+                with open(path + '.folded', 'w') as f:
+                    for stack, count in profile.items():
+                        f.write('{} {}\n'.format(stack, count))
+            _prune()
+        return response
+
+    @server.teardown_request
+    def _release_profile(exc):
+        # Make sure the profiler is released if the request failed before
+        # after_request
+        if flask.g.get('profile') is not None:
+            _stop(flask.g.pop('profile')[0])
+
+    def _check_auth():
+        if auth is not None and not auth.is_authorized():
+            return auth.login_request()
+        return None
+
+    def _list():
+        return _check_auth() or flask.jsonify(list_profiles(directory))
+
+    def _download(name):
+        denied = _check_auth()
+        if denied is not None:
+            return denied
+        if name not in [profile['name'] for profile in list_profiles(directory)]:
+            flask.abort(404)
+        if flask.request.args.get('format') == 'txt':
+            path = os.path.join(directory, name)
+            if name.endswith('.folded'):
+                summary = _summarize_folded(path)
+            else:
+                stream = io.StringIO()
+                stats = pstats.Stats(path, stream=stream)
+                stats.sort_stats('cumulative').print_stats(50)
+                summary = stream.getvalue()
+            return flask.Response(summary, mimetype='text/plain')
+        return flask.send_from_directory(os.path.abspath(directory), name,
+                                         as_attachment=True)
+
+    server.add_url_rule(route, 'list_profiles', _list)
+    server.add_url_rule(route + '/<name>', 'download_profile', _download)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+'''
+Batch scan of monthly traces for anomalies
+
+Usage:
+
+* To add the anomaly scores of all buildings to the data file, type the
+  following in the terminal:
+    > python scan_anomalies.py path_to_data.csv
+  where path_to_data.csv is the path to the csv file containing the data. The
+  step, spike and zero run statistics and the anomaly score of each fuel (see
+  lib.scan_anomalies()) are written as 'summary' columns, replacing those of
+  any previous scan, so that the web app can filter and color buildings by
+  anomaly without scanning at startup.
+
+* Add --out path_to_output.csv to write to a new file instead of updating the
+  data file in place.
+
+Anthony Ho <anthony.ho@energy.ca.gov>
+'''
+
+
+import os
+import argparse
+import pandas as pd
+import lib
+
+
+def main():
+    description = 'Add anomaly scores of monthly traces to a data file'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--out', default=None,
+                        help='path to the output file (default: update in place)')
+    parser.add_argument('file', help='path to the billing data file')
+    args = parser.parse_args()
+    out = args.out or args.file
+
+    # Scan traces
+    bills = lib.read_processed_bills(args.file)
+    scores = lib.scan_anomalies(bills)
+    del bills
+    print('{} of {} buildings flagged'.format(
+        int((scores.xs('summary', axis=1).filter(like='_anom_score') >= 1)
+            .any(axis=1).sum()),
+        len(scores)))
+
+    # Add scores to the raw file, read as text so that all other columns are
+    # written back unchanged
+    raw = pd.read_csv(args.file, header=[0, 1], dtype=str)
+    for col in scores:
+        raw[col] = scores[col].values
+
+    # Write to a temporary file first so that an interrupted run never leaves
+    # a truncated data file behind
+    raw.to_csv(out + '.tmp', index=False)
+    os.replace(out + '.tmp', out)
+
+
+if __name__ == '__main__':
+    main()